@@ -4,6 +4,7 @@
 
 from .common import GrTest, git_results, addExec, checked
 
+import argparse
 import datetime
 import os
 import re
@@ -12,6 +13,7 @@ import shutil
 import signal
 import subprocess
 import textwrap
+import threading
 import time
 
 def checkTag(tag):
@@ -23,6 +25,22 @@ def checkTag(tag):
             0].strip()
 
 
+class StandInExecutor(git_results.PrefixExecutor):
+    """A PrefixExecutor whose "remote" shell is a new local one, started
+    outside of the experiment's folder and without git-results' environment,
+    as a remote shell would be."""
+    def __init__(self):
+        git_results.PrefixExecutor.__init__(self, "sh -c")
+
+
+    def _popen(self, argv):
+        env = { k: os.environ[k] for k in [ 'HOME', 'LOGNAME', 'LANG' ]
+                if k in os.environ }
+        return subprocess.Popen(argv, cwd='/', env=env,
+                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+
+
 class TestGitResults(GrTest):
     def _assertTagMatchesMessage(self, tag, suffix = ""):
         """Ensure that the git-results-message file matches the tagged commit.
@@ -145,6 +163,41 @@ class TestGitResults(GrTest):
         self.assertEqual("results/t2\n", open("results/t2/1/run").read())
 
 
+    def test_gitSessionTags(self):
+        # Tags written by flush() may be deleted by the same session, and
+        # existing tags are not replaced
+        self._setupRepo()
+        git = git_results.GitSession(os.getcwd())
+        try:
+            git.createTag("a", "HEAD", "first")
+            git.createTag("b", "HEAD", "second")
+            with self.assertRaises(ValueError):
+                git.createTag("a", "HEAD", "again")
+            git.flush()
+            self.assertEqual([ "a", "b" ], checked([ "git", "tag" ]).split())
+
+            git.deleteTag("a")
+            with self.assertRaises(ValueError):
+                git.createTag("b", "HEAD", "again")
+            git.createTag("c", "HEAD", "never written")
+            git.deleteTag("c")
+            git.flush()
+            self.assertEqual([ "b" ], checked([ "git", "tag" ]).split())
+            self.assertEqual("second", checked([ "git", "tag", "-l",
+                    "--format=%(contents)", "b" ]).strip())
+
+            # Tags written outside of the session are seen, too
+            self.assertEqual(True, git.hasTag("b"))
+            checked([ "git", "tag", "-a", "-m", "outside", "d" ])
+            with self.assertRaises(ValueError):
+                git.createTag("d", "HEAD", "again")
+            git.deleteTag("d")
+            git.flush()
+            self.assertEqual([ "b" ], checked([ "git", "tag" ]).split())
+        finally:
+            git.close()
+
+
     def test_ignore(self):
         self._setupRepo()
         with open("test", "w") as f:
@@ -186,6 +239,35 @@ class TestGitResults(GrTest):
             self.assertEqual(True, os.path.lexists(root + "/f/e/b"))
 
 
+    def test_ignoreDirectory(self):
+        # Subtrees ignored with /** are never walked; a later negation keeps
+        # them walkable.
+        m = git_results.IgnoreMatcher([ "pyc" ], [ "/data/**", "*.log" ])
+        self.assertTrue(m.isPruned("data"))
+        self.assertFalse(m.isPruned("data2"))
+        self.assertFalse(m.isPruned("sub/data"))
+        self.assertTrue(m.isIgnored("data/a/b"))
+        self.assertTrue(m.isIgnored("sub/a.log"))
+        self.assertTrue(m.isIgnored("a.pyc"))
+        self.assertFalse(m.isIgnored("sub/data"))
+
+        m = git_results.IgnoreMatcher([], [ "/data/**", "!data/keep" ])
+        self.assertFalse(m.isPruned("data"))
+        self.assertTrue(m.isIgnored("data/a"))
+        self.assertFalse(m.isIgnored("data/keep"))
+
+        self._setupRepo()
+        self._config(r"""
+                [/]
+                build = "mkdir -p data/sub && touch data/sub/old"
+                run = "touch data/a data/sub/b out"
+                ignore = [ "/data/**" ]
+                """)
+        git_results.run(shlex.split("results/test -m 'h'"))
+        self.assertEqual(False, os.path.lexists("results/test/1/data"))
+        self.assertEqual(True, os.path.lexists("results/test/1/out"))
+
+
     def test_link(self):
         # Check linking
         self._setupRepo()
@@ -217,6 +299,38 @@ class TestGitResults(GrTest):
                 open("results/latest/test/run3-fail/stdout").read())
 
 
+    def test_lockFile(self):
+        # Locks exclude other threads, as well as other processes, and are
+        # removed along with their caches once an experiment moves away
+        self._setupRepo()
+        git_results.run(shlex.split("results/test -m 'a'"))
+        base = os.getcwd()
+        experimentDir = os.path.abspath("results/test")
+        path = git_results._getExperimentLockPath(base, experimentDir)
+        self.assertEqual(True, os.path.lexists(path))
+        self.assertEqual(True, os.path.lexists(path + ".next"))
+
+        events = []
+        def other():
+            with git_results.lockExperiment(base, experimentDir):
+                events.append("other")
+        with git_results.lockExperiment(base, experimentDir):
+            thread = threading.Thread(target = other)
+            thread.start()
+            time.sleep(0.2)
+            events.append("main")
+            # The waiting thread locks a new file, rather than the removed one
+            git_results.pruneExperimentLock(base, experimentDir)
+            self.assertEqual(False, os.path.lexists(path))
+        thread.join()
+        self.assertEqual([ "main", "other" ], events)
+        self.assertEqual(True, os.path.lexists(path))
+
+        git_results.run(shlex.split("move results/test results/test2"))
+        self.assertEqual([], [ f for f in os.listdir(os.path.dirname(path))
+                if f.startswith(os.path.basename(path)) ])
+
+
     def test_move(self):
         # Check basic move case
         self._setupRepo()
@@ -241,6 +355,442 @@ class TestGitResults(GrTest):
         self._assertTagMatchesMessage("results/test/run/1")
 
 
+    def test_sweep(self):
+        # One snapshot, numbered runs for each point, one build per command
+        self._setupRepo()
+        # Outside of the repository, so that it does not change the tree
+        log = os.path.abspath("../buildlog")
+        git_results.safeRemove(log)
+        self._config("""
+                vars = {{ "lr": "0", "depth": "0" }}
+                build = "echo {{depth}} >> {0} && echo {{depth}} > built"
+                run = "echo {{lr}} $(cat built) > out"
+                """.format(log))
+        git_results.run(shlex.split("sweep results/test -m 'grid' "
+                "-g lr=1,2 -g depth=a,b -j 3"))
+        self.assertEqual([ "a", "b" ], sorted(open(log).read().split()))
+        points = [ ("1", "a"), ("1", "b"), ("2", "a"), ("2", "b") ]
+        commit = checkTag("results/test/1")
+        for i, (lr, depth) in enumerate(points, 1):
+            self.assertEqual("{} {}\n".format(lr, depth),
+                    open("results/test/{}/out".format(i)).read())
+            self.assertIn("vars: lr={} depth={}\n".format(lr, depth),
+                    open("results/test/{}/git-results-message".format(i))
+                        .read())
+            self.assertEqual(commit, checkTag("results/test/{}".format(i)))
+        index = open("results/test/INDEX").read()
+        self.assertIn("1 (  ok) - [lr=1 depth=a] grid\n", index)
+        self.assertIn("4 (  ok) - [lr=2 depth=b] grid\n", index)
+        self.assertEqual(os.path.abspath("results/test/4"),
+                os.path.realpath("results/latest/test"))
+        self.assertEqual(False, os.path.lexists("results/.tmp"))
+
+        # Explicit points, and failures are reported but do not stop others
+        self._config("""
+                run = "test {lr} = 3 && echo {lr} > out"
+                """)
+        with self.assertRaises(SystemExit):
+            git_results.run(shlex.split("sweep results/test -m 'list' "
+                    "-s 'lr=3 depth=b' -s 'lr=4 depth=b'"))
+        self.assertEqual("3\n", open("results/test/5/out").read())
+        self.assertEqual(True, os.path.lexists("results/test/6-fail"))
+
+
+    def test_sweep_isolated(self):
+        # Runs which share a build each get their own copy of its outputs
+        self._setupRepo()
+        self._config("""
+                vars = { "lr": "0" }
+                build = "echo built > out"
+                run = "cat out > got && echo {lr} >> out"
+                """)
+        git_results.run(shlex.split("sweep results/test -m 'shared' "
+                "-g lr=1,2,3 -j 1"))
+        for i in [ 1, 2, 3 ]:
+            self.assertEqual("built\n", open("results/test/{}/got".format(i))
+                    .read())
+
+
+    def test_stageLimits(self):
+        # With maxRuns, later experiments build while earlier ones run, but
+        # runs do not overlap
+        self._setupRepo()
+        # Outside of the repository, so that it does not change the tree
+        log = os.path.abspath("../runlog")
+        git_results.safeRemove(log)
+        self._config("""
+                maxBuilds = 1
+                maxRuns = 1
+                build = "echo build >> {0}"
+                run = "echo start >> {0}; sleep 0.5; echo end >> {0}"
+                """.format(log))
+        git_results.run(shlex.split("sweep results/test -m 'pipe' "
+                "--no-build-cache -g x=1,2 -j 2"))
+        lines = open(log).read().split()
+        self.assertEqual([ "start", "end" ] * 2, [ l for l in lines
+                if l != "build" ])
+        self.assertLess(len(lines) - 1 - lines[::-1].index("build"),
+                len(lines) - 1 - lines[::-1].index("start"))
+        for i in [ 1, 2 ]:
+            self.assertEqual(True, os.path.isdir("results/test/{}".format(i)))
+
+        self._config("""
+                maxRuns = -1
+                """)
+        with self.assertRaises(ValueError):
+            git_results.run(shlex.split("results/test -m 'bad'"))
+
+
+    def test_concurrentLaunches(self):
+        # Experiments launched at once get distinct numbers and INDEX entries
+        self._setupRepo()
+        git_results.run(shlex.split("results/test -m 'first'"))
+        # Local changes, so that each launch commits a snapshot
+        with open("hello_world", "a") as f:
+            f.write("echo 'modified'\n")
+        env = dict(os.environ, GIT_EDITOR = "true")
+        procs = [ subprocess.Popen([ "git", "results", "results/test", "-m",
+                "many" ], env = env, stdout = subprocess.DEVNULL,
+                stderr = subprocess.PIPE) for _ in range(8) ]
+        for p in procs:
+            _stdout, stderr = p.communicate()
+            self.assertEqual(0, p.returncode, stderr)
+        nums = [ str(i) for i in range(1, 10) ]
+        self.assertEqual(sorted(nums + [ "INDEX" ]),
+                sorted(os.listdir("results/test")))
+        index = open("results/test/INDEX").read()
+        self.assertEqual(sorted(nums), sorted(re.findall(r"^(\d+) \(  ok\)",
+                index, re.M)))
+        for i in nums:
+            self.assertNotEqual(None, checkTag("results/test/" + i))
+        self.assertIn(os.path.basename(os.path.realpath(
+                "results/latest/test")), nums)
+
+
+    def test_experimentCounter(self):
+        # Numbers come from a counter rather than listing the experiment,
+        # unless something other than git-results changed it
+        self._setupRepo()
+        scans = []
+        oldScan = git_results._scanNextExperimentNumber
+        def scan(experimentDir):
+            scans.append(experimentDir)
+            return oldScan(experimentDir)
+        git_results._scanNextExperimentNumber = scan
+        try:
+            git_results.run(shlex.split("results/test -m 'count'"))
+            del scans[:]
+            for i in range(2):
+                git_results.run(shlex.split("results/test -m 'count'"))
+            self.assertEqual(0, len(scans))
+            self.assertEqual(sorted([ "1", "2", "3", "INDEX" ]),
+                    sorted(os.listdir("results/test")))
+
+            # A folder in the way is skipped, but never reused
+            os.makedirs("results/test/4-fail")
+            git_results.run(shlex.split("results/test -m 'count'"))
+            self.assertTrue(os.path.isdir("results/test/5"))
+            self.assertNotEqual([], scans)
+            del scans[:]
+
+            # As is a number only in INDEX
+            with open("results/test/INDEX", "a") as f:
+                f.write("7 (  ok) - Added by hand\n")
+            git_results.run(shlex.split("results/test -m 'count'"))
+            self.assertTrue(os.path.isdir("results/test/8"))
+            self.assertNotEqual([], scans)
+            del scans[:]
+
+            # GONE numbers are reused
+            self._config("""
+                    [/results/test]
+                    build = "false"
+                    """)
+            with self.assertRaises(SystemExit):
+                git_results.run(shlex.split("results/test -m 'fail'"))
+            self.assertIn("9 (gone)", open("results/test/INDEX").read())
+            self._config("""
+                    [/results/test]
+                    build = "cp hello_world hello_world_2"
+                    """)
+            git_results.run(shlex.split("results/test -m 'count'"))
+            self.assertTrue(os.path.isdir("results/test/9"))
+            self.assertEqual([], scans)
+        finally:
+            git_results._scanNextExperimentNumber = oldScan
+
+
+    def test_list(self):
+        # The catalog is made on first use, kept up to date, and may be
+        # rebuilt from the results folders
+        self._setupRepo()
+        git_results.run(shlex.split("results/test/run -m 'Woo'"))
+        self.assertFalse(os.path.lexists("results/.catalog.sqlite"))
+        out = checked([ "git", "results", "list", "results" ])
+        self.assertIn("Cataloging results", out)
+        self.assertRegex(out, r"\nresults/test/run/1 +ok +\S+ \S+ +\S+s +\S+s "
+                r"+\d+ +Woo\n")
+
+        self._config("""
+                [/results/bad]
+                run = "exit 1"
+                """)
+        with self.assertRaises(SystemExit):
+            git_results.run(shlex.split("results/bad -m 'Boo'"))
+        git_results.run(shlex.split("move results/test/run/1 "
+                "results/test/run2/1"))
+        git_results.run(shlex.split("link results/test/run2 results/linked"))
+
+        catalog = git_results.Catalog(os.path.abspath("results"))
+        rows = catalog.query("results", sort = 'tag')
+        self.assertEqual([ ("results/bad/1", "fail", "Boo"),
+                ("results/linked/1", "ok", "Woo"),
+                ("results/test/run/1", "move",
+                    "(moved to results/test/run2/1) Woo"),
+                ("results/test/run2/1", "ok", "Woo") ],
+                [ (r['tag'], r['state'], r['message']) for r in rows ])
+        bad = rows[0]
+        self.assertEqual(checkTag("results/bad/1"), bad['commitSha'])
+        self.assertLess(abs(time.time() - bad['started']), 60)
+        self.assertGreaterEqual(bad['duration'], 0)
+        self.assertGreaterEqual(bad['buildTime'], 0)
+        self.assertEqual(git_results.getFolderSize("results/bad/1-fail"),
+                bad['size'])
+        self.assertEqual(rows[1]['commitSha'], rows[3]['commitSha'])
+
+        self.assertEqual([ "results/bad/1" ], [ r['tag'] for r in
+                catalog.query("results", states = [ "fail" ]) ])
+        self.assertEqual([ "results/test/run/1", "results/test/run2/1" ],
+                [ r['tag'] for r in catalog.query("results/test",
+                    sort = 'tag') ])
+        self.assertEqual([], catalog.query("results", since = time.time()
+                + 60))
+        self.assertEqual([ "results/test/run2/1" ], [ r['tag'] for r in
+                catalog.query("results", sort = 'tag', reverse = True,
+                    limit = 1) ])
+        out = checked([ "git", "results", "list", "results", "-s", "fail",
+                "-s", "move" ])
+        # Oldest first
+        self.assertEqual([ "tag", "results/test/run/1", "results/bad/1" ],
+                [ l.split()[0] for l in out.strip().split("\n") ])
+
+        # Rebuilt from the folders, the same rows are found.  Started times
+        # only have a resolution of seconds in git-results-message.
+        os.unlink("results/.catalog.sqlite")
+        checked([ "git", "results", "list", "results", "--rebuild" ])
+        def key(r):
+            return dict(r, started = int(r['started'] or 0))
+        self.assertEqual([ key(r) for r in rows ], [ key(r) for r in
+                catalog.query("results", sort = 'tag') ])
+
+
+    def test_executor(self):
+        # Output, exit codes, and the working folder pass through executors
+        self._setupRepo()
+        self._config("""
+                run = "pwd > where; echo out; echo err >&2; test -z \\"$FOO\\""
+                """)
+        os.environ['FOO'] = 'leaked'
+        git_results.TEST_EXECUTORS['standin'] = StandInExecutor
+        try:
+            for i, executor in enumerate([ "standin", "prefix sh -c",
+                    "local" ], 1):
+                self._config("""
+                        executor = "{}"
+                        """.format(executor))
+                git_results.run(shlex.split("results/test -m 'a'"))
+                self.assertEqual("out\n", open("results/test/{}/stdout"
+                        .format(i)).read())
+                self.assertEqual("err\n", open("results/test/{}/stderr"
+                        .format(i)).read())
+                self.assertIn("/results/.tmp/", open("results/test/{}/where"
+                        .format(i)).read())
+
+            self._config("""
+                    executor = "standin"
+                    run = "exit 3"
+                    """)
+            with self.assertRaises(SystemExit):
+                git_results.run(shlex.split("results/test -m 'a'"))
+            self.assertIn("termination: 3",
+                    open("results/test/4-fail/stderr").read())
+
+            self._config("""
+                    executor = "ssh"
+                    """)
+            with self.assertRaises(ValueError):
+                git_results.run(shlex.split("results/test -m 'a'"))
+        finally:
+            del os.environ['FOO']
+            del git_results.TEST_EXECUTORS['standin']
+
+
+    def test_queue(self):
+        # Queued experiments run from their snapshot, pinned, one per CPU
+        self._setupRepo()
+        queueDir = git_results.JobQueue.getDefault()._dir
+        shutil.rmtree(queueDir, ignore_errors = True)
+        # Outside of the repository, so that it does not change the tree
+        log = os.path.abspath("../runlog")
+        git_results.safeRemove(log)
+        cpu = min(os.sched_getaffinity(0))
+        self._config("""
+                run = "echo start >> {0}; sleep 0.5; echo end >> {0}; grep Cpus_allowed_list /proc/self/status > cpus; cat hello_world > hw"
+                """.format(log))
+        git_results.run(shlex.split("queue results/test -m 'a'"))
+        # Changes after queueing are not part of the experiment
+        with open("hello_world", "a") as f:
+            f.write("echo 'modified'\n")
+        git_results.run(shlex.split("queue -c 1 results/test -m 'b'"))
+        # Never fits, so is left queued
+        git_results.run(shlex.split("queue -c 10000 results/test -m 'c'"))
+        self.assertEqual(3, len(git_results.JobQueue.getDefault().list()))
+        self.assertEqual(False, os.path.lexists("results/test"))
+
+        git_results.run([ "worker", "--until-empty", "--cpus", str(cpu) ])
+        self.assertEqual("start\nend\nstart\nend\n", open(log).read())
+        for i in [ 1, 2 ]:
+            self.assertEqual(str(cpu), open("results/test/{}/cpus".format(i))
+                    .read().split()[-1])
+        self.assertNotIn("modified", open("results/test/1/hw").read())
+        self.assertIn("modified", open("results/test/2/hw").read())
+        self.assertEqual(1, len(git_results.JobQueue.getDefault().list()))
+
+        # A job claimed by a worker which went away is queued again
+        queue = git_results.JobQueue.getDefault()
+        os.unlink(queue.list()[0])
+        git_results.run(shlex.split("queue results/test -m 'd'"))
+        path, fd = queue.claim(queue.list()[0], [ cpu ])
+        os.close(fd)
+        self.assertEqual([], queue.list())
+        git_results.run([ "worker", "--until-empty", "--cpus", str(cpu) ])
+        self.assertEqual(True, os.path.lexists("results/test/3/hw"))
+        self.assertEqual([], os.listdir(os.path.join(queueDir, "running")))
+
+
+    def test_snapshotLeavesRepoAlone(self):
+        # Committing local changes for an experiment does not touch the
+        # user's branch, index, or files
+        self._setupRepo()
+        with open("staged", "w") as f:
+            f.write("s\n")
+        checked([ "git", "add", "staged", "git-results.cfg" ])
+        with open("untracked", "w") as f:
+            f.write("u\n")
+        with open("hello_world", "a") as f:
+            f.write("echo 'modified'\n")
+        head = checked([ "git", "rev-parse", "HEAD" ])
+        branch = checked([ "git", "symbolic-ref", "HEAD" ])
+        status = checked([ "git", "status", "--porcelain" ])
+        diffCached = checked([ "git", "diff", "--cached" ])
+
+        git_results.run(shlex.split("results/test -m 'snap'"))
+
+        self.assertEqual(head, checked([ "git", "rev-parse", "HEAD" ]))
+        self.assertEqual(branch, checked([ "git", "symbolic-ref", "HEAD" ]))
+        self.assertEqual(diffCached, checked([ "git", "diff", "--cached" ]))
+        # .gitignore was added to by git-results
+        self.assertEqual(status.replace("?? results/\n", ""),
+                checked([ "git", "status", "--porcelain" ]).replace(
+                    " M .gitignore\n", "").replace("?? .gitignore\n", ""))
+        self.assertEqual("Hello, world\nmodified\n",
+                open("results/test/1/stdout").read())
+
+        commit = checkTag("results/test/1")
+        self.assertEqual(commit, checked([ "git", "rev-parse",
+                "git-results" ]).strip())
+        self.assertEqual(head.strip(), checked([ "git", "rev-parse",
+                commit + "^" ]).strip())
+        self.assertEqual("u\n", checked([ "git", "show",
+                commit + ":untracked" ]))
+        self.assertEqual("snap", checked([ "git", "log", "-n1", "--format=%B",
+                commit ]).strip())
+
+
+    def test_moveManyGitProcesses(self):
+        # Moving many experiments starts a fixed number of git processes,
+        # and keeps each tag's message and commit
+        self._setupRepo()
+        for i in range(5):
+            git_results.run(shlex.split("results/test/run -m 'Woo {}'"
+                    .format(i)))
+        commits = [ checkTag("results/test/run/{}".format(i))
+                for i in range(1, 6) ]
+
+        started = []
+        oldPopen = subprocess.Popen
+        def newPopen(cmd, *args, **kwargs):
+            if cmd[0] == "git":
+                started.append(cmd)
+            return oldPopen(cmd, *args, **kwargs)
+        subprocess.Popen = newPopen
+        try:
+            git_results.run(shlex.split("move results/test/run "
+                    "results/test/run2"))
+        finally:
+            subprocess.Popen = oldPopen
+
+        self.assertLessEqual(len(started), 6)
+        self.assertEqual("", checked([ "git", "tag", "-l",
+                "results/test/run/*" ]))
+        for i in range(1, 6):
+            tag = "results/test/run2/{}".format(i)
+            self.assertEqual(commits[i - 1], checkTag(tag))
+            self.assertEqual("Woo {}".format(i - 1), checked([ "git", "tag",
+                    "-l", "--format=%(contents)", tag ]).strip())
+
+
+    def test_meta(self):
+        # git-results-meta.json describes each experiment without parsing
+        # git-results-message
+        self._setupRepo()
+        self._config("""
+                [vars]
+                word = "hi"
+                words = "{word} {word}"
+
+                [/results/bad]
+                run = "echo {words} && exit 3"
+                """)
+        with self.assertRaises(SystemExit):
+            git_results.run(shlex.split("results/bad -m 'Boo'"))
+        meta = git_results.readMeta("results/bad/1-fail")
+        self.assertEqual("results/bad/1", meta['tag'])
+        self.assertEqual(checkTag("results/bad/1"), meta['commit'])
+        self.assertEqual("Boo", meta['message'])
+        self.assertEqual("echo hi hi && exit 3", meta['run'])
+        self.assertEqual("cp hello_world hello_world_2", meta['build'])
+        self.assertEqual(None, meta['progress'])
+        self.assertEqual({ "word": "hi", "words": "hi hi" }, meta['vars'])
+        self.assertEqual(3, meta['exitCode'])
+        self.assertEqual(0, meta['retries'])
+        self.assertEqual(0, meta['harvested'])
+        self.assertLessEqual(meta['started'], meta['ended'])
+        self.assertGreaterEqual(meta['buildDuration'], 0)
+        self.assertAlmostEqual(meta['ended'] - meta['started'],
+                meta['buildDuration'] + meta['runDuration'], delta = 1)
+
+        # Move finds the commit of an untagged experiment from it
+        checked([ "git", "tag", "-d", "results/bad/1" ])
+        with open("results/bad/1-fail/git-results-message", "w") as f:
+            f.write("Lost\n")
+        git_results.run(shlex.split("move results/bad results/bad2"))
+        self.assertEqual(meta['commit'], checkTag("results/bad2/1"))
+        self.assertEqual("results/bad2/1", git_results.readMeta(
+                "results/bad2/1-fail")['tag'])
+
+        # Errors in git-results itself are recorded, with the exit code
+        # returned
+        self._config("""
+                run = "rm {0}/git-results-message && mkdir {0}/git-results-message"
+                """.format(os.path.abspath("results/bad/1-run")))
+        with self.assertRaises(SystemExit):
+            git_results.run(shlex.split("results/bad -m 'Boo'"))
+        meta = git_results.readMeta("results/bad/1-fail")
+        self.assertEqual(9001, meta['exitCode'])
+        self.assertLessEqual(meta['started'], meta['ended'])
+
+
     def test_moveExperiment(self):
         # Accidentally ran a tag as another tag, move the experiment
         self._setupRepo()
@@ -893,6 +1443,319 @@ else:
         self.assertEqual("Lucky was 8\n", open('results/t/3/stdout').read())
 
 
+    def test_failToMoveResults_crossDevice(self):
+        # Results on a different file system than the checkout are copied
+        old = git_results.FolderState.moveResultsTo
+        def newMove(self, dir, trimCommonPaths = False):
+            oldRename = os.rename
+            def newRename(a, b):
+                if '.git-results-part' not in a:
+                    raise OSError(18, "Invalid cross-device link")
+                return oldRename(a, b)
+            os.rename = newRename
+            try:
+                return old(self, dir, trimCommonPaths = trimCommonPaths)
+            finally:
+                os.rename = oldRename
+        git_results.FolderState.moveResultsTo = newMove
+        try:
+            self._setupRepo()
+            self._config("""
+                    run = "mkdir a && echo yodel > a/alpha && ln -s alpha a/link && chmod 600 a/alpha"
+                    """)
+            git_results.run(shlex.split("results/test -m 'h'"))
+        finally:
+            git_results.FolderState.moveResultsTo = old
+
+        self.assertEqual("yodel\n", open("results/test/1/a/alpha").read())
+        self.assertEqual("alpha", os.readlink("results/test/1/a/link"))
+        self.assertEqual(0o600,
+                os.stat("results/test/1/a/alpha").st_mode & 0o777)
+        self.assertEqual([], [ f for f in os.listdir("results/test/1/a")
+                if f.endswith(".git-results-part") ])
+
+        # And for real, if there is a tmpfs around
+        if os.path.isdir("/dev/shm"):
+            data = os.urandom(3 << 20)
+            with open("big", "wb") as f:
+                f.write(data)
+            dst = os.path.join("/dev/shm", "git-results-test-big")
+            git_results.moveAcrossDevices("big", dst)
+            try:
+                self.assertEqual(False, os.path.lexists("big"))
+                self.assertEqual(data, open(dst, "rb").read())
+            finally:
+                os.unlink(dst)
+
+
+    def test_sharedCheckout(self):
+        # The experiment's checkout borrows the repository's objects rather
+        # than copying them
+        self._setupRepo()
+        self._config("""
+                run = "cat $(git rev-parse --git-path objects/info/alternates) > alt; git count-objects | cut -d' ' -f1 > count; git rev-parse HEAD > head"
+                """)
+        git_results.run(shlex.split("results/test -m 'h'"))
+
+        objects = os.path.abspath(checked([ "git", "rev-parse", "--git-path",
+                "objects" ]).strip())
+        self.assertEqual(objects + "\n", open("results/test/1/alt").read())
+        self.assertEqual("0\n", open("results/test/1/count").read())
+        self.assertEqual(checked([ "git", "rev-parse", "results/test/1^{commit}" ]),
+                open("results/test/1/head").read())
+
+
+    def test_buildCache(self):
+        # Builds with the same inputs are restored rather than run again
+        self._setupRepo()
+        # Outside of the repository, so that it does not change the tree
+        log = os.path.abspath("../buildlog")
+        git_results.safeRemove(log)
+        self._config("""
+                buildCache = 1e6
+                build = "echo built >> {0} && mkdir -p out && echo x > out/bin && ln -s bin out/link"
+                run = "cat out/link > got"
+                """.format(log))
+        git_results.run(shlex.split("results/test -m 'a'"))
+        git_results.run(shlex.split("results/test -m 'b'"))
+        self.assertEqual("built\n", open(log).read())
+        for i in [ 1, 2 ]:
+            self.assertEqual("x\n", open("results/test/{}/got".format(i))
+                    .read())
+            self.assertEqual(False, os.path.lexists(
+                    "results/test/{}/out".format(i)))
+
+        git_results.run(shlex.split("results/test -m 'c' --no-build-cache"))
+        self.assertEqual("built\n" * 2, open(log).read())
+        self._config("""
+                vars = {{ "x": "1" }}
+                build = "echo built >> {0} && mkdir -p out && echo {{x}} > out/bin && ln -s bin out/link"
+                """.format(log))
+        git_results.run(shlex.split("results/test -m 'd'"))
+        self.assertEqual("built\n" * 3, open(log).read())
+        self.assertEqual("1\n", open("results/test/4/got").read())
+
+        # Least recently used entries are evicted beyond the size limit
+        cacheDir = os.path.abspath("results/.tmp/build-cache")
+        self.assertEqual([ ".lock" ], [ f for f in os.listdir(cacheDir)
+                if len(f) != 40 ])
+        self.assertEqual(3, len(os.listdir(cacheDir)))
+        # Each entry is 5 bytes
+        git_results.BuildCache(cacheDir, 5)._evict()
+        self.assertEqual(2, len(os.listdir(cacheDir)))
+
+
+    def test_buildCache_isolated(self):
+        # Writing to a stored or restored file in place does not change the
+        # cache entry
+        self.initAndChdirTmp()
+        cache = git_results.BuildCache(os.path.abspath("cache"), 1e6)
+        for d in [ "a", "b" ]:
+            git_results.safeMake(d)
+        with open("a/bin", "w") as f:
+            f.write("built\n")
+        cache.store("key", "a", [ "bin" ])
+        with open("a/bin", "r+") as f:
+            f.write("BUILT")
+        self.assertEqual(True, cache.restore("key", "b"))
+        self.assertEqual("built\n", open("b/bin").read())
+        with open("b/bin", "r+") as f:
+            f.write("run")
+        self.assertEqual(True, cache.restore("key", "b"))
+        self.assertEqual("built\n", open("b/bin").read())
+
+
+    def test_memoize(self):
+        # Identical experiments which finished OK are linked, not run again
+        self._setupRepo()
+        # Outside of the repository, so that it does not change the tree
+        log = os.path.abspath("../runlog")
+        git_results.safeRemove(log)
+        self._config("""
+                memoize = True
+                run = "echo ran >> {}; echo result > out"
+                """.format(log))
+        git_results.run(shlex.split("results/test -m 'a'"))
+        git_results.run(shlex.split("results/test -m 'b'"))
+        self.assertEqual("ran\n", open(log).read())
+        self.assertEqual("1", os.readlink("results/test/2"))
+        self.assertEqual("result\n", open("results/test/2/out").read())
+        self.assertEqual("result\n", open("results/latest/test/out").read())
+        self.assertEqual(os.path.realpath("results/test/1"),
+                os.path.realpath(os.path.join(os.path.dirname(
+                    self._getDatedBase()), "{}-test/2".format(
+                        datetime.datetime.now().strftime("%d")))))
+        self.assertEqual(("2", git_results.IndexStates.OK, "b"),
+                git_results.indexRead(".", "results/test/2"))
+        self.assertNotEqual(None, checkTag("results/test/2"))
+
+        # Different inputs run again
+        self._config("""
+                run = "echo ran >> {}; echo other > out"
+                """.format(log))
+        git_results.run(shlex.split("results/test -m 'c'"))
+        self.assertEqual("ran\nran\n", open(log).read())
+        self.assertEqual("other\n", open("results/test/3/out").read())
+
+        # Failed experiments are not reused
+        self._config("""
+                run = "echo ran >> {}; false"
+                """.format(log))
+        for m in [ 'd', 'e' ]:
+            with self.assertRaises(SystemExit):
+                git_results.run(shlex.split("results/test -m '{}'".format(m)))
+        self.assertEqual("ran\n" * 4, open(log).read())
+
+
+    def test_sparseCheckout(self):
+        # Only the cfg folder, top-level files, and checkout paths are written
+        self._setupRepo()
+        os.makedirs("data/big")
+        os.makedirs("lib")
+        os.makedirs("sub")
+        for f in [ "data/big/a", "lib/b", "sub/c" ]:
+            with open(f, "w") as fh:
+                fh.write("x\n")
+        checked([ "git", "add", "-A" ])
+        checked([ "git", "commit", "-m", "Layout" ])
+        self._config("""
+                [/]
+                checkout = [ "/lib/" ]
+                run = "cd .. && find . -path ./.git -prune -o -type f ! -name files -print | sort > sub/files"
+                workspacePool = 1
+                """, cfgPath = "sub/git-results.cfg")
+        git_results.run(shlex.split("sub/results/test -m 'a'"))
+        self.assertEqual("./.gitignore\n./git-results.cfg\n./hello_world\n"
+                "./lib/b\n./sub/c\n./sub/git-results.cfg\n",
+                open("sub/results/test/1/files").read())
+
+        # A kept workspace goes back to a full checkout
+        self._config("""
+                checkout = []
+                """, cfgPath = "sub/git-results.cfg")
+        git_results.run(shlex.split("sub/results/test -m 'b'"))
+        self.assertIn("./data/big/a\n", open("sub/results/test/2/files").read())
+
+
+    def test_workspacePool(self):
+        # Checkouts are reused between experiments, cleaned in between
+        self._setupRepo()
+        self._config("""
+                workspacePool = 1
+                build = "test ! -e out && touch built"
+                run = "pwd > out"
+                """)
+        git_results.run(shlex.split("results/test -m 'a'"))
+        git_results.run(shlex.split("results/test -m 'b'"))
+        self.assertEqual(open("results/test/1/out").read(),
+                open("results/test/2/out").read())
+        self.assertEqual(False, os.path.lexists("results/test/2/built"))
+        pool = sorted(os.listdir("results/.tmp/pool"))
+        self.assertEqual(3, len(pool))
+        self.assertEqual([ ".lock", pool[1], pool[1] + ".lease" ], pool)
+
+        # Leased workspaces are not shared, and the pool does not grow past
+        # its size
+        p = git_results.WorkspacePool(os.path.abspath("results/.tmp/pool"), 1,
+                1e6)
+        p2 = git_results.WorkspacePool(os.path.abspath("results/.tmp/pool"),
+                1, 1e6)
+        w = p.acquire()
+        self.assertEqual(os.path.abspath("results/.tmp/pool/" + pool[1]), w)
+        self.assertEqual(None, p2.acquire())
+        p.release(w)
+
+        # Idle workspaces are evicted
+        p2 = git_results.WorkspacePool(os.path.abspath("results/.tmp/pool"),
+                1, -1.)
+        w = p2.acquire()
+        p2.release(w)
+        self.assertEqual([ ".lock" ], os.listdir("results/.tmp/pool"))
+
+        for idle in [ "0", "-1", "\"day\"" ]:
+            self._config("""
+                    workspacePoolIdle = {}
+                    """.format(idle))
+            with self.assertRaises(ValueError):
+                git_results.run(shlex.split("results/test -m 'bad'"))
+
+
+    def test_failToMoveResults_busy(self):
+        # A busy file is retried later, without holding up the others
+        old = git_results.FolderState.moveResultsTo
+        busy = []
+        def newMove(self, dir, trimCommonPaths = False):
+            oldRename = os.rename
+            def newRename(a, b):
+                if os.path.basename(a) == "blah" and len(busy) < 2:
+                    busy.append(time.time())
+                    raise OSError(16, "Device or resource busy")
+                return oldRename(a, b)
+            os.rename = newRename
+            try:
+                return old(self, dir, trimCommonPaths = trimCommonPaths)
+            finally:
+                os.rename = oldRename
+        git_results.FolderState.moveResultsTo = newMove
+        try:
+            self._setupRepo()
+            self._config("""
+                    run = "mkdir -p a/b c && echo yodel > a/b/alpha; echo gosh > a/blah; echo gee > c/cansas"
+                    """)
+            git_results.run(shlex.split("results/test -m 'h'"))
+        finally:
+            git_results.FolderState.moveResultsTo = old
+
+        self.assertEqual(2, len(busy))
+        self.assertGreaterEqual(busy[1] - busy[0], 0.9)
+        self.assertEqual("yodel\n", open("results/test/1/a/b/alpha").read())
+        self.assertEqual("gosh\n", open("results/test/1/a/blah").read())
+        self.assertEqual("gee\n", open("results/test/1/c/cansas").read())
+
+
+    def test_pathTable(self):
+        self.initAndChdirTmp()
+        files = [ ("a", (1, 2, 3)), ("b/c", (4, 5, 6)), ("b/d", (7, 8, 9)),
+                ("b/e/f", (0, 0, 0)), ("bb/g", (1, 1, 1)),
+                ("b/file_0001", (2, 2, 2)), ("b/file_0002", (3, 3, 3)) ]
+        table = git_results.PathTable.build(files, True)
+        self.assertEqual([ "a", "b/c", "b/d", "b/file_0001", "b/file_0002",
+                "b/e/f", "bb/g" ], list(table))
+        self.assertEqual((4, 5, 6), table.get("b/c"))
+        self.assertEqual((2, 2, 2), table.get("b/file_0001"))
+        self.assertEqual(False, "b" in table)
+        self.assertEqual(False, "b/x" in table)
+
+        # Range deletion of a folder and its subfolders, but not siblings
+        self.assertEqual([ "b/c", "b/d", "b/file_0001", "b/file_0002",
+                "b/e/f" ], table.forget("b"))
+        self.assertEqual([ "a", "bb/g" ], list(table))
+        self.assertEqual([ "a" ], table.forget("a"))
+        self.assertEqual(1, len(table))
+
+        # Siblings such as data-2 sort between data and data/sub
+        siblings = git_results.PathTable.build([ ("data/x", None),
+                ("data-2/y", None), ("data/sub/z", None),
+                ("data.old", None) ], False)
+        self.assertEqual([ "data/x", "data/sub/z" ],
+                siblings.forget("data"))
+        self.assertEqual([ "data.old", "data-2/y" ], list(siblings))
+
+        table.save("table")
+        loaded = git_results.PathTable.load("table")
+        self.assertEqual([ ("bb/g", (1, 1, 1)) ], list(loaded.items()))
+        table = git_results.PathTable.build(files, False)
+        table.save("table")
+        loaded = git_results.PathTable.load("table")
+        self.assertEqual(None, loaded.get("b/e/f", False))
+        self.assertEqual(len(files), len(loaded))
+
+        with open("table", "w") as f:
+            f.write("Hehfaiwehf")
+        with self.assertRaises(ValueError):
+            git_results.PathTable.load("table")
+
+
     def test_failToMoveResults(self):
         # Ensure that if a result file fails to move, the test is marked as
         # failed
@@ -947,6 +1810,121 @@ else:
             git_results.FolderState.moveResultsTo = old
 
 
+    def test_folderState_deep(self):
+        # A tree deeper than Python's recursion limit is still scanned.
+        self.initAndChdirTmp()
+        args = argparse.Namespace(ignoreExt = [ "pyc" ], ignore = [],
+                scanThreads = 1, includeModified = False,
+                trackChanges = False, harvest = [])
+        os.makedirs("work/old")
+        open("work/old/a", "w").close()
+        fs = git_results.FolderState(os.path.abspath("work"),
+                os.path.abspath("results"), args)
+
+        # os.makedirs and shutil.rmtree both recurse, so avoid them here.
+        deep = "work"
+        for _ in range(1200):
+            deep = os.path.join(deep, "d")
+            os.mkdir(deep)
+        open(os.path.join(deep, "b"), "w").close()
+        open(os.path.join(deep, "b.pyc"), "w").close()
+        os.symlink(os.path.abspath("work/old"), "work/dirLink")
+        fs.moveResultsTo(os.path.abspath("results"), trimCommonPaths = True)
+
+        self.assertEqual([ "b" ], os.listdir("results"))
+        self.assertEqual(True, os.path.lexists("work/old/a"))
+        checked([ "rm", "-rf", "work" ])
+
+
+    def test_folderState_parallel(self):
+        # scanThreads > 1 must see exactly the same files as a serial scan
+        self.initAndChdirTmp()
+        for i in range(20):
+            os.makedirs("work/{}/sub/.hidden".format(i))
+            for f in [ "a", "b.pyc", "sub/c", "sub/.hidden/d" ]:
+                open("work/{}/{}".format(i, f), "w").close()
+        os.makedirs("work/results/x")
+        open("work/results/x/e", "w").close()
+
+        states = []
+        for threads in [ 1, 8 ]:
+            args = argparse.Namespace(ignoreExt = [ "pyc" ],
+                    ignore = [ "/1/**" ], scanThreads = threads,
+                    includeModified = False, trackChanges = False,
+                    harvest = [])
+            states.append(git_results.FolderState(os.path.abspath("work"),
+                    os.path.abspath("work/results/x"), args))
+        self.assertEqual(57, len(states[0]._files))
+        self.assertEqual(list(states[0]._files), list(states[1]._files))
+
+        # And is usable from git-results.cfg
+        self._setupRepo()
+        self._config(r"""
+                [/]
+                scanThreads = 4
+                run = "mkdir -p a/b && touch a/b/c a/d"
+                """)
+        git_results.run(shlex.split("results/test -m 'h'"))
+        self.assertEqual(True, os.path.lexists("results/test/1/a/b/c"))
+        self.assertEqual(True, os.path.lexists("results/test/1/a/d"))
+        self.assertEqual(False, os.path.lexists("results/test/1/hello_world"))
+
+
+    def test_folderState_trackChanges(self):
+        # With trackChanges, results come from inotify rather than a rescan
+        self.initAndChdirTmp()
+        os.makedirs("work/old")
+        with open("work/old/a", "w") as f:
+            f.write("a")
+        open("work/old/b", "w").close()
+        args = argparse.Namespace(ignoreExt = [ "pyc" ], ignore = [],
+                scanThreads = 1, includeModified = True, trackChanges = True,
+                harvest = [])
+        fs = git_results.FolderState(os.path.abspath("work"),
+                os.path.abspath("results"), args)
+        fs.startTracking()
+        def noWalk():
+            raise AssertionError("Should not rescan")
+        fs._walk = noWalk
+
+        os.makedirs("work/new/sub")
+        open("work/new/sub/c", "w").close()
+        open("work/new/c.pyc", "w").close()
+        with open("work/old/a", "a") as f:
+            f.write("a")
+        open("work/tmp", "w").close()
+        os.unlink("work/tmp")
+        fs.moveResultsTo(os.path.abspath("results"))
+        self.assertEqual("aa", open("results/old/a").read())
+        self.assertEqual(True, os.path.lexists("results/new/sub/c"))
+        self.assertEqual(False, os.path.lexists("results/new/c.pyc"))
+        self.assertEqual(False, os.path.lexists("results/old/b"))
+        self.assertEqual(False, os.path.lexists("results/tmp"))
+
+        # An incomplete journal falls back to a full scan
+        fs = git_results.FolderState(os.path.abspath("work"),
+                os.path.abspath("results2"), args)
+        fs.startTracking()
+        open("work/d", "w").close()
+        os.rename("work/new", "work/new2")
+        open("work/new2/e", "w").close()
+        fs.moveResultsTo(os.path.abspath("results2"))
+        self.assertEqual(True, os.path.lexists("results2/d"))
+        self.assertEqual(True, os.path.lexists("results2/new2/e"))
+
+        # And from git-results.cfg
+        self._setupRepo()
+        self._config(r"""
+                [/]
+                trackChanges = True
+                run = "mkdir -p a/b && touch a/b/c a/d"
+                """)
+        git_results.run(shlex.split("results/test -m 'h'"))
+        self.assertEqual(True, os.path.lexists("results/test/1/a/b/c"))
+        self.assertEqual(True, os.path.lexists("results/test/1/a/d"))
+        self.assertEqual(False, os.path.lexists("results/test/1/hello_world"))
+
+
     def test_ignoreExt(self):
         # Make sure ignoreExt works
         self._setupRepo()
@@ -1022,6 +2000,177 @@ else:
                 git_results.indexRead("", "a/b/2"))
 
 
+    def test_indexOffsets(self):
+        # Records are found by offset rather than by reading all of INDEX
+        self._setupRepo()
+        for i in range(1, 201):
+            git_results.indexWrite("", "a/b/{}".format(i), " run",
+                    "Message {} ".format(i) * (i % 20 + 1))
+        scans = []
+        oldScan = git_results._indexScan
+        def scan(contents, base=0):
+            scans.append(len(contents))
+            return oldScan(contents, base)
+        git_results._indexScan = scan
+        try:
+            exp, state, message = git_results.indexRead("", "a/b/57")
+            self.assertEqual(('57', ' run'), (exp, state))
+            # Wrapped, and shortened to three lines
+            self.assertTrue(message.startswith("Message 57 Message 57"))
+            self.assertEqual(3, len(message.split("\n")))
+            git_results.indexUpdate("", "a/b/57", "  ok")
+            self.assertEqual('  ok', git_results.indexRead("", "a/b/57")[1])
+            with self.assertRaises(git_results.NotInIndexError):
+                git_results.indexRead("", "a/b/201")
+            self.assertEqual([], scans)
+
+            # Rewriting a record only rescans the records after it
+            git_results.indexWrite("", "a/b/199", "move", "Moved")
+            self.assertEqual(1, len(scans))
+            self.assertLess(scans[0], 1000)
+            self.assertEqual(('200', ' run', 'Message 200'),
+                    git_results.indexRead("", "a/b/200"))
+            self.assertEqual(('199', 'move', 'Moved'),
+                    git_results.indexRead("", "a/b/199"))
+            self.assertEqual(1, len(scans))
+
+            # Edits by hand are noticed
+            with open("a/b/INDEX") as f:
+                contents = f.read()
+            with open("a/b/INDEX", "w") as f:
+                f.write("0 (  ok) - By hand\n" + contents)
+            self.assertEqual(('57', '  ok'),
+                    git_results.indexRead("", "a/b/57")[:2])
+            self.assertEqual(('0', '  ok', 'By hand'),
+                    git_results.indexRead("", "a/b/0"))
+        finally:
+            git_results._indexScan = oldScan
+        self.assertEqual(200, len(re.findall(r"^[1-9]\d* \(", open(
+                "a/b/INDEX").read(), re.M)))
+
+
+    def test_harvest(self):
+        # Files matching harvest are moved out while the run is going, and
+        # still end up trimmed correctly
+        self._setupRepo()
+        self._config(r"""
+                [/]
+                harvest = [ "*.pt" ]
+                harvestInterval = 0.05
+                trim = True
+                run = "mkdir out && echo 1 > out/a.pt && echo 2 > out/b && sleep 1.5 && (test -e out/a.pt || touch out/moved) && test -e out/b"
+                """)
+        git_results.run(shlex.split("results/test -m 'h'"))
+        self.assertEqual("1\n", open("results/test/1/a.pt").read())
+        self.assertEqual(True, os.path.lexists("results/test/1/b"))
+        self.assertEqual(True, os.path.lexists("results/test/1/moved"))
+        self.assertEqual(False, os.path.lexists("results/test/1/out"))
+        self.assertEqual(1, git_results.readMeta("results/test/1")[
+                'harvested'])
+
+        # Also with trackChanges
+        self._config(r"""
+                trackChanges = True
+                """)
+        git_results.run(shlex.split("results/test -m 'h'"))
+        self.assertEqual("1\n", open("results/test/2/a.pt").read())
+        self.assertEqual(True, os.path.lexists("results/test/2/moved"))
+
+        # With trackChanges, a file is not moved while still being written,
+        # however long its writer pauses
+        self._config(r"""
+                run = "mkdir out && (echo 1; sleep 0.5; test -e out/a.pt && echo 2) > out/a.pt && sleep 0.5 && (test -e out/a.pt || touch out/moved)"
+                """)
+        git_results.run(shlex.split("results/test -m 'h'"))
+        self.assertEqual("1\n2\n", open("results/test/3/a.pt").read())
+        self.assertEqual(True, os.path.lexists("results/test/3/moved"))
+
+        self._config("""
+                harvestInterval = 0
+                """)
+        with self.assertRaises(ValueError):
+            git_results.run(shlex.split("results/test -m 'bad'"))
+
+
+    def test_harvest_crossDevice(self):
+        # Harvesting works when results are on a different file system than
+        # the checkout
+        old = git_results.FolderState._harvestPass
+        def newPass(self, dir, seen):
+            oldRename = os.rename
+            def newRename(a, b):
+                if '.git-results-part' not in a:
+                    raise OSError(18, "Invalid cross-device link")
+                return oldRename(a, b)
+            os.rename = newRename
+            try:
+                return old(self, dir, seen)
+            finally:
+                os.rename = oldRename
+        git_results.FolderState._harvestPass = newPass
+        try:
+            self._setupRepo()
+            self._config(r"""
+                    [/]
+                    harvest = [ "*.pt" ]
+                    harvestInterval = 0.05
+                    run = "echo 1 > a.pt && sleep 1 && (test -e a.pt || touch moved)"
+                    """)
+            git_results.run(shlex.split("results/test -m 'h'"))
+        finally:
+            git_results.FolderState._harvestPass = old
+
+        self.assertEqual("1\n", open("results/test/1/a.pt").read())
+        self.assertEqual(True, os.path.lexists("results/test/1/moved"))
+        self.assertEqual(1, git_results.readMeta("results/test/1")[
+                'harvested'])
+
+
+    def test_includeModified(self):
+        # Files from the build or the repository which the run changes are only
+        # results with includeModified
+        self._setupRepo()
+        self._config("""
+                [/]
+                build = "echo a > cache && echo a > same"
+                run = "echo b >> cache && echo b >> hello_world && touch new"
+                """)
+        git_results.run(shlex.split("results/test -m 'h'"))
+        self.assertEqual(False, os.path.lexists("results/test/1/cache"))
+        self.assertEqual(True, os.path.lexists("results/test/1/new"))
+
+        self._config("""
+                includeModified = True
+                """)
+        git_results.run(shlex.split("results/test -m 'h'"))
+        self.assertEqual("a\nb\n", open("results/test/2/cache").read())
+        self.assertEqual(True, os.path.lexists("results/test/2/hello_world"))
+        self.assertEqual(True, os.path.lexists("results/test/2/new"))
+        self.assertEqual(False, os.path.lexists("results/test/2/same"))
+
+
+    def test_includeModified_inPlace(self):
+        # With --in-place, changed files from the user's working tree are
+        # copied into the results rather than moved out of the tree
+        self._setupRepo()
+        self._config("""
+                [/]
+                includeModified = True
+                harvest = [ "hello_*" ]
+                harvestInterval = 0.05
+                build = ""
+                run = "echo b >> hello_world && sleep 0.5 && touch new"
+                """)
+        git_results.run(shlex.split("-i wresults/test -m 'h'"))
+        self.assertEqual("echo 'Hello, world'\n"
+                "echo 'Hello run' > hello_world_run\nb\n",
+                open("wresults/test/1/hello_world").read())
+        self.assertEqual(open("wresults/test/1/hello_world").read(),
+                open("hello_world").read())
+        self.assertIn("new", os.listdir("wresults/test/1"))
+        self.assertNotIn("new", os.listdir("."))
+
+
     def test_inPlace(self):
         # Ensure that in-place works
         self._setupRepo()